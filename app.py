@@ -4,15 +4,21 @@
 # - UK-friendly defaults (gl=uk, hl=en)
 # - Optional client (chrome/firefox/...)
 # - A–Z expansion + prefix/suffix combos
-# - Progress bar, RPM pacing, retry with backoff
+# - Concurrent fetching, progress bar, RPM pacing, retry with backoff
 # - De‑duplication, summary table, CSV export
 # - Playground for a single query (shows raw JSON)
 # - Reads SERPAPI_KEY from Streamlit Secrets or env (do NOT hardcode keys)
 
+import io
 import os
 import time
 import string
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import requests
+from requests.adapters import HTTPAdapter, Retry
+from urllib3.util import make_headers
 import pandas as pd
 import streamlit as st
 
@@ -64,8 +70,9 @@ with st.sidebar:
                     help="Adds a small delay between requests to avoid throttling.")
     delay = 60.0 / float(rpm)
     max_retries = st.slider("Max retries", 0, 5, 2)
-    backoff_base = st.slider("Backoff (seconds)", 1, 10, 3,
-                             help="Wait time grows with each retry.")
+    backoff_base = st.slider("Backoff factor (seconds)", 1, 10, 3,
+                             help="First retry is immediate, then factor × 2ⁿ⁻¹ s "
+                                  "(capped by urllib3). A 429's Retry-After takes precedence.")
 
     st.divider()
     st.caption("Generation options")
@@ -73,6 +80,9 @@ with st.sidebar:
                          help="For each seed, also query 'seed a'..'seed z'.")
     use_prefix_suffix = st.checkbox("Use prefix/suffix lists", value=False,
                                     help="Combine seeds with your prefixes/suffixes.")
+    min_base_hits = st.slider("Min seed suggestions to expand", 0, 10, 1,
+                              help="Only run A–Z / prefix / suffix variants for seeds whose own "
+                                   "query returned at least this many suggestions (0 = always).")
     unique_only = st.checkbox("De‑duplicate suggestions per seed", value=True)
     keep_seed_row = st.checkbox("Include base seed queries in output", value=True)
 
@@ -96,8 +106,36 @@ with st.sidebar:
 # Helpers
 # -------------------------
 API_URL = "https://serpapi.com/search"
+MAX_WORKERS = 8  # concurrent in‑flight queries; RPM pacing still applies
+UI_REFRESH = 0.1  # min seconds between progress/status redraws
 
-def serpapi_autocomplete(q: str, gl: str, hl2: str, client_opt: str, api_key: str):
+@st.cache_resource
+def _http(max_retries: int, backoff_base: float):
+    """
+    Shared session so queries reuse pooled keep‑alive connections to SerpAPI.
+    Transient failures (429/5xx, connection errors) are retried by the adapter
+    with exponential backoff, honouring Retry-After; other errors fail fast.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_base,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+        raise_on_status=False,  # hand back the last response so we can report its error body
+    )
+    s = requests.Session()
+    # requests only advertises gzip/deflate; urllib3's list adds br (and zstd)
+    # whenever the decoder package is installed, so it never asks for what it can't decode.
+    s.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    # Single host: one pool, one keep‑alive connection per worker thread. Blocking
+    # on a full pool reuses warm connections instead of opening throwaway ones.
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+                          pool_maxsize=MAX_WORKERS, pool_block=True)
+    s.mount("https://", adapter)
+    return s
+
+def _serpapi_autocomplete_raw(q: str, gl: str, hl2: str, client_opt: str, api_key: str, pacer=None):
     """
     SerpAPI Google Autocomplete.
     Endpoint: /search?engine=google_autocomplete
@@ -116,52 +154,119 @@ def serpapi_autocomplete(q: str, gl: str, hl2: str, client_opt: str, api_key: st
     if client_opt:
         params["client"] = client_opt
 
-    r = requests.get(API_URL, params=params, timeout=20)
+    if pacer is not None:
+        pacer.wait()
+    r = _http(max_retries, backoff_base).get(API_URL, params=params, timeout=20)
+    if pacer is not None:
+        pacer.observe(
+            remaining=_header_number(r, "X-RateLimit-Remaining"),
+            retry_after=_header_number(r, "Retry-After") if r.status_code == 429 else None,
+        )
 
     # surface helpful error messages
     try:
         r.raise_for_status()
     except requests.HTTPError as e:
-        detail = ""
         try:
-            detail = r.json().get("error") or r.json().get("message") or ""
+            j = orjson.loads(r.content)
+            detail = j.get("error") or j.get("message") or ""
         except Exception:
-            detail = r.text[:300]
+            detail = r.content[:300].decode("utf-8", "replace")
         raise RuntimeError(f"SerpAPI error {r.status_code}: {detail}") from e
 
-    data = r.json()
+    data = orjson.loads(r.content)  # decode bytes directly; skips requests' charset sniffing
     suggestions = data.get("suggestions", [])  # list of dicts with 'value'
     values = []
     for i, s in enumerate(suggestions, start=1):
         val = s.get("value")
         if val:
             values.append((i, val))
-    # Also return header usage if present
-    remaining = r.headers.get("X-RateLimit-Remaining")
-    return values, remaining
+    return values
 
-def with_retry(fn, *args, **kwargs):
-    tries = 0
-    while True:
-        try:
-            return fn(*args, **kwargs)
-        except Exception as e:
-            tries += 1
-            if tries > max_retries:
-                raise
-            time.sleep(backoff_base * tries)
+@st.cache_data(ttl=3600, show_spinner=False)
+def serpapi_autocomplete_cached(q: str, gl: str, hl2: str, client_opt: str, _pacer=None):
+    """
+    Cached by (q, gl, hl, client). The API key is read from SERPAPI_KEY so it
+    never becomes part of the cache key; cache hits skip `_pacer` entirely.
+    Only suggestions are cached; live rate-limit headers go to `_pacer`.
+    """
+    return _serpapi_autocomplete_raw(q, gl, hl2, client_opt, SERPAPI_KEY, _pacer)
+
+def _header_number(r, name: str):
+    """Numeric response header, or None if missing / not a number."""
+    try:
+        return float(r.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+class Pacer:
+    """
+    Hands out request start slots across threads. The gap starts at the RPM
+    interval and follows SerpAPI's feedback: while X-RateLimit-Remaining is
+    low it is set to spread what is left over BUDGET_WINDOW, it decays back
+    once there is headroom, and a 429's Retry-After holds every slot until it
+    has passed.
+    """
+    LOW_WATER = 0.1       # "low" = under 10% of the highest remaining seen this run
+    BUDGET_WINDOW = 3600.0  # seconds to stretch a low remaining budget over
+    MAX_INTERVAL = 60.0
+
+    def __init__(self, interval: float):
+        self.floor = interval  # never faster than the configured RPM
+        self.interval = interval
+        self._next = time.monotonic()
+        self._peak = 0.0
+        self.remaining = None  # latest X-RateLimit-Remaining from a real response
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if self._cancelled.wait(max(0.0, slot - now)):
+            raise RuntimeError("Run cancelled before this query was sent.")
+
+    def cancel(self):
+        """Wake every waiting thread and refuse further slots."""
+        self._cancelled.set()
+
+    def observe(self, remaining=None, retry_after=None):
+        with self._lock:
+            if retry_after:
+                self._next = max(self._next, time.monotonic() + retry_after)
+            if remaining is None:
+                return
+            self.remaining = remaining
+            self._peak = max(self._peak, remaining)
+            if remaining <= self._peak * self.LOW_WATER:
+                # A target from the current budget, not growth per response:
+                # several responses land per slot, so compounding would pin
+                # the cap for the rest of the run.
+                target = self.BUDGET_WINDOW / remaining if remaining > 0 else self.MAX_INTERVAL
+                self.interval = max(self.floor, min(self.MAX_INTERVAL, target))
+            else:
+                self.interval = max(self.floor, self.interval * 0.95)
 
 def expand_queries(seed: str):
-    """Make query variants for a seed based on toggles."""
-    variants = [seed]
+    """Make query variants for a seed based on toggles (de‑duped, order kept)."""
+    # Seeds, prefixes and suffixes arrive stripped and non‑empty, so every
+    # variant is already clean; a dict doubles as an insertion‑ordered set.
+    out = {seed: None}
     if use_az:
-        variants += [f"{seed} {ch}" for ch in string.ascii_lowercase]
-    if prefixes:
-        variants += [f"{p} {seed}" for p in prefixes]
-    if suffixes:
-        variants += [f"{seed} {s}" for s in suffixes]
-    # de‑dupe, preserve order
-    return list(dict.fromkeys([v.strip() for v in variants if v.strip()]))
+        for ch in string.ascii_lowercase:
+            out[f"{seed} {ch}"] = None
+    for p in prefixes:
+        out[f"{p} {seed}"] = None
+    for s in suffixes:
+        out[f"{seed} {s}"] = None
+    return list(out)
+
+def to_csv_bytes(df: pd.DataFrame, sep: str) -> bytes:
+    buf = io.BytesIO()  # encode straight to bytes; no intermediate str copy
+    df.to_csv(buf, index=False, sep=sep, encoding="utf-8")
+    return buf.getvalue()
 
 # -------------------------
 # Main UI
@@ -181,9 +286,12 @@ if show_playground:
     q = st.text_input("Test a single query", value="coffee")
     if st.button("Test query"):
         try:
-            values, remaining = with_retry(serpapi_autocomplete, q, gl, hl, client, SERPAPI_KEY)
+            pacer = Pacer(delay)
+            values = serpapi_autocomplete_cached(q, gl, hl, client, pacer)
+            # None on a cache hit: no request was made, so there is no fresh header
+            remaining = None if pacer.remaining is None else int(pacer.remaining)
             st.write({"suggestions": [v for _, v in values], "rate_limit_remaining": remaining})
-        except Exception as e:
+        except (requests.RequestException, RuntimeError, ValueError) as e:
             st.error(str(e))
 
 # Run batch
@@ -195,54 +303,143 @@ if run:
         st.error("Add at least one seed.")
         st.stop()
 
-    rows = []
-    total_queries = sum(len(expand_queries(seed)) for seed in seeds)
+    expanded = {seed: expand_queries(seed) for seed in seeds}
+    for seed, queries in expanded.items():
+        if keep_seed_row and seed not in queries:
+            queries.insert(0, seed)
+
     progress = st.progress(0)
     status = st.empty()
-    done = 0
-    last_remaining = None
+    # "total" starts as an upper bound and shrinks once stage 1 has decided
+    # which seeds are worth expanding.
+    tally = {
+        "done": 0,
+        "total": len(dict.fromkeys(q for qs in expanded.values() for q in qs)),
+        "last_ui": 0.0,
+    }
 
-    for seed in seeds:
-        queries = expand_queries(seed)
-        if keep_seed_row and seed not in queries:
-            queries.insert(0, seed)
+    # Requests start on the (adaptive) RPM schedule but overlap in flight, so
+    # latency no longer stacks on top of the pacing delay.
+    pacer = Pacer(delay)
 
-        for q in queries:
-            status.write(f"Fetching **{q}** …")
+    def fetch(q):
+        return serpapi_autocomplete_cached(q, gl, hl, client, pacer)
+
+    results = {}
+
+    def fetch_all(pool, queries):
+        """Fetch each distinct query not already in `results`, updating progress."""
+        futures = {pool.submit(fetch, q): q for q in dict.fromkeys(queries) if q not in results}
+        for fut in as_completed(futures):
+            q = futures[fut]
             try:
-                suggestions, remaining = with_retry(serpapi_autocomplete, q, gl, hl, client, SERPAPI_KEY)
-                last_remaining = remaining
-                if not suggestions:
-                    rows.append({"seed": seed, "query_sent": q, "position": None, "suggestion": None})
-                else:
-                    for pos, text in suggestions:
-                        rows.append({"seed": seed, "query_sent": q, "position": pos, "suggestion": text})
-            except Exception as e:
-                rows.append({"seed": seed, "query_sent": q, "position": None, "suggestion": None, "error": str(e)})
-
-            done += 1
-            progress.progress(int(done * 100 / max(1, total_queries)))
-            time.sleep(delay)
+                results[q] = fut.result()
+            except (requests.RequestException, RuntimeError, ValueError) as e:
+                results[q] = e
+            tally["done"] += 1
+            # Throttle widget updates (each is a websocket round‑trip) to ~10/s
+            now = time.monotonic()
+            if now - tally["last_ui"] >= UI_REFRESH or tally["done"] == tally["total"]:
+                status.write(f"Fetched **{q}** ({tally['done']}/{tally['total']})")
+                progress.progress(int(tally["done"] * 100 / max(1, tally["total"])))
+                tally["last_ui"] = now
+
+    def base_hits(seed):
+        """Suggestion count for the bare seed, or None if its fetch failed."""
+        res = results[seed]
+        return None if isinstance(res, Exception) else len(res)
+
+    not_expanded = []  # seeds whose variants were skipped by the threshold
+
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        # Stage 1: the bare seeds. A trunk with no completions rarely has any
+        # for 'seed a'..'seed z' or its prefix/suffix combos either, so only
+        # seeds with at least `min_base_hits` suggestions get expanded. A
+        # failed base fetch tells us nothing about that, so it still expands.
+        fetch_all(pool, seeds)
+        pairs = []
+        for seed, queries in expanded.items():
+            hits = base_hits(seed)
+            if len(queries) > 1 and hits is not None and hits < min_base_hits:
+                not_expanded.append(seed)
+                queries = [seed]
+            pairs += [(seed, q) for q in queries]
+
+        # Stage 2: every remaining distinct query once — overlapping seeds
+        # share a single API call.
+        pending = [q for q in dict.fromkeys(q for _, q in pairs) if q not in results]
+        tally["total"] = tally["done"] + len(pending)
+        fetch_all(pool, pending)
+    finally:
+        # Normally every future is done by now. If the run was interrupted (Stop,
+        # a widget change, an unexpected error) don't keep sending queued queries:
+        # drop them and wake any thread still waiting for a pacing slot.
+        pacer.cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Columnar build: one list per column, one DataFrame allocation at the end
+    seeds_col, queries_col, pos_col, sugg_col, err_col = [], [], [], [], []
+
+    def add_row(seed, q, pos=None, text=None, err=None):
+        seeds_col.append(seed)
+        queries_col.append(q)
+        pos_col.append(pos)
+        sugg_col.append(text)
+        err_col.append(err)
+
+    best = {}  # (seed, suggestion) -> row index, for de‑dup during ingestion
+    for seed, q in pairs:
+        res = results[q]
+        if isinstance(res, Exception):
+            add_row(seed, q, err=str(res))
+            continue
+        suggestions = res
+        if not suggestions:
+            add_row(seed, q)
+        else:
+            for pos, text in suggestions:
+                if unique_only:
+                    # keep one row per (seed, suggestion), at its best position
+                    i = best.get((seed, text))
+                    if i is not None:
+                        if pos < pos_col[i]:
+                            queries_col[i], pos_col[i] = q, pos
+                        continue
+                    best[(seed, text)] = len(sugg_col)
+                add_row(seed, q, pos, text)
 
     progress.empty(); status.empty()
 
-    df = pd.DataFrame(rows)
-
-    # De‑dup per seed if requested
-    if unique_only and not df.empty:
-        df = df.sort_values(["seed", "suggestion", "position"], na_position="last")
-        df = df.drop_duplicates(subset=["seed", "suggestion"], keep="first")
+    # seed/query_sent repeat heavily -> categorical; positions are 1..10 -> Int8
+    # (nullable, so rows without a suggestion don't upcast to float64)
+    df = pd.DataFrame({
+        "seed": pd.Categorical(seeds_col),
+        "query_sent": pd.Categorical(queries_col),
+        "position": pd.array(pos_col, dtype="Int8"),
+        "suggestion": sugg_col,
+        "error": err_col,
+    })
 
     if df.empty:
         st.warning("No suggestions returned.")
     else:
+        # Start the CSV encode now so it overlaps with rendering the tables below
+        sep = {",": ",", ";": ";", "\\t": "\t"}[csv_sep]
+        # (a per-run worker, so one session's big export never queues behind another's)
+        csv_pool = ThreadPoolExecutor(max_workers=1)
+        csv_future = csv_pool.submit(to_csv_bytes, df, sep)
+        csv_pool.shutdown(wait=False)  # worker exits once this encode is done
+
         st.markdown("### Results")
         st.dataframe(df, use_container_width=True)
 
         # Summary: unique suggestion count per seed
+        # (one hash pass over the pairs instead of a nunique per group)
         summary = (
-            df.dropna(subset=["suggestion"])
-              .groupby("seed")["suggestion"].nunique()
+            df.dropna(subset=["suggestion"])[["seed", "suggestion"]]
+              .drop_duplicates()
+              .groupby("seed", sort=False, observed=True).size()
               .reset_index(name="unique_suggestions")
               .sort_values("unique_suggestions", ascending=False)
         )
@@ -250,14 +447,19 @@ if run:
         st.dataframe(summary, use_container_width=True)
 
         # Export CSV
-        sep = {",": ",", ";": ";", "\\t": "\t"}[csv_sep]
         st.download_button(
             "Download CSV",
-            df.to_csv(index=False, sep=sep).encode("utf-8"),
+            csv_future.result(),
             file_name="autocomplete_results.csv",
             mime="text/csv"
         )
 
-    # Rate limit hint if header was available
-    if last_remaining is not None:
-        st.caption(f"SerpAPI X-RateLimit-Remaining: {last_remaining}")
+    if not_expanded:
+        st.caption(
+            f"Not expanded (fewer than {min_base_hits} suggestions for the seed itself): "
+            + ", ".join(not_expanded)
+        )
+
+    # Rate limit hint from the most recent network response, if any
+    if pacer.remaining is not None:
+        st.caption(f"SerpAPI X-RateLimit-Remaining: {int(pacer.remaining)}")